@@ -26,16 +26,15 @@ We should NOT use the tare function, since the tare zero point is lost through
 a reset. Instead, let's store it in the database.
 """
 
-import datetime
+from collections import deque
 import math
 import re
+import time
 from typing import Optional
 
 import arrow
-import bitstring
-from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal, pyqtSlot
 import serial
-from whisker.lang import CompiledRegexMemory
 from whisker.qt import exit_on_exception
 
 from starfeeder.constants import (
@@ -105,12 +104,51 @@ BAUDRATE_PAUSE_MS = 200  # p64 ("approx. 150ms"); p17 ("<15 ms")
 
 RESPONSE_UNKNOWN = '?'
 RESPONSE_NONSPECIFIC_OK = '0'
+OK_ACK_COMMANDS = frozenset([  # commands that reply RESPONSE_NONSPECIFIC_OK
+    CMD_ASCII_RESULT_OUTPUT,
+    CMD_DATA_DELIMITER_COMMA_CR_LF,
+    CMD_FILTER_TYPE,
+    CMD_MEASUREMENT_RATE,
+    CMD_SET_BAUD_RATE,
+    CMD_SET_FILTER,
+    CMD_TARE,
+])
 BAUDRATE_REGEX = re.compile(r"^(\d+),(\d)$")  # e.g. 09600,1
+# Parity codes used by the BDR command.
+PARITY_TO_CODE = {
+    serial.PARITY_NONE: 0,
+    serial.PARITY_EVEN: 1,
+}
+CODE_TO_PARITY = {code: parity for parity, code in PARITY_TO_CODE.items()}
+
+COMMAND_SEPARATOR_STR = ";"
+COMMAND_SEPARATOR = COMMAND_SEPARATOR_STR.encode('ascii')
+
+# There is no "value unit" reply to parse (e.g. "99.99 g"): the balance
+# doesn't actually work out any mass for you. MSV? replies are raw integers,
+# which we convert using our own calibration; see value_to_mass().
+
+
+def parse_int(text: str) -> Optional[int]:
+    """
+    Parses an integer reply (e.g. " -1234") from the balance. Returns None,
+    without raising, if it isn't one; a noisy serial line can produce a lot
+    of junk, and we'd rather not pay for an exception each time.
+    """
+    digits = text.strip()
+    if digits[:1] in ('-', '+'):
+        digits = digits[1:]
+    if not digits.isdigit():
+        return None
+    return int(text)
 
-COMMAND_SEPARATOR = b";"
 
-# NONSENSE # MASS_REGEX = re.compile(r"^(.*)\s+(\w+)$")  # e.g. "99.99 g" [5]
-# ... the balance doesn't actually work out any mass for you.
+def monotonic_time_of(timestamp: arrow.Arrow) -> float:
+    """
+    Converts a recent wall-clock timestamp (e.g. when a line arrived at the
+    serial port) to the time.monotonic() clock, by way of its age.
+    """
+    return time.monotonic() - (time.time() - timestamp.float_timestamp)
 
 
 class BalanceController(SerialController):  # separate controller thread
@@ -133,15 +171,39 @@ class BalanceController(SerialController):  # separate controller thread
         # So, for example, at 6 Hz we could have 5 per cycle.
         self.measurements_per_batch = math.ceil(
             0.5 * self.balance_config.measurement_rate_hz)  # type: int
-        self.command_queue = []
+        # One MSV command fetches a whole batch; send() queues the first
+        # expected reply and start_measuring() adds the rest.
+        self.measure_queue_extension = (
+            (CMD_QUERY_MEASURE, ) * (self.measurements_per_batch - 1))
+        self.measure_batch_params = str(self.measurements_per_batch)
+        self.command_queue = deque()  # replies expected, oldest on the left
         self.n_pending_measurements = 0
         self.rfid_event_rfid = None
-        self.rfid_event_expires = arrow.now()
+        self.rfid_event_expires = time.monotonic()  # monotonic clock, s
         self.max_value = 100000  # default (NOV command) is 100,000
-        self.recent_measurements_kg = []
+        self.recent_measurements_kg = None  # type: deque
+        self.recent_min_kg = None  # type: deque
+        self.recent_max_kg = None  # type: deque
+        self.n_measurements = 0
+        self.clear_recent_measurements()
+        self.kg_per_unit = None  # type: Optional[float]
+        self.update_calibration_scale()
         self.pending_calibrate = False
         self.pending_tare = False
         self.locked = False
+        # Outgoing commands are collected and written together; see send().
+        self.send_batch = []  # command strings awaiting flush_sends()
+        self.send_batch_delay_ms = 0
+        self.send_flush_scheduled = False
+        # What to do with the reply to each command:
+        # (MSV? replies are handled directly by on_receive(), not via here.)
+        self.reply_handlers = {
+            CMD_QUERY_BAUD_RATE: self.on_baud_rate_reply,
+            CMD_SET_BAUD_RATE: self.on_baud_rate_reply,
+            CMD_QUERY_STATUS: self.on_status_reply,
+            CMD_QUERY_IDENTIFICATION: self.on_identification_reply,
+            CMD_QUERY_OUTPUT_SCALING: self.on_output_scaling_reply,
+        }
 
     @pyqtSlot()
     @exit_on_exception
@@ -151,10 +213,33 @@ class BalanceController(SerialController):  # separate controller thread
 
     def send(self, command: str, params: str = '', reply_expected: bool = True,
              delay_ms: int = 0) -> None:
+        """
+        Queues a command for the balance. Commands sent during one turn of
+        our event loop go to the writer as a single string (joined by the
+        command separator, so the bytes on the wire are the same), unless
+        a delay is required before one of them.
+        """
         params = str(params)  # just in case we have a number
         if reply_expected:
             self.command_queue.append(command)
-        msg = command + params
+        if delay_ms > 0 and self.send_batch:
+            # The delay must come between the batch so far and this command.
+            self.flush_sends()
+        if not self.send_batch:
+            self.send_batch_delay_ms = delay_ms
+        self.send_batch.append(command + params)
+        if not self.send_flush_scheduled:
+            self.send_flush_scheduled = True
+            QTimer.singleShot(0, self.flush_sends)
+
+    def flush_sends(self) -> None:
+        self.send_flush_scheduled = False
+        if not self.send_batch:
+            return
+        msg = COMMAND_SEPARATOR_STR.join(self.send_batch)
+        delay_ms = self.send_batch_delay_ms
+        self.send_batch = []
+        self.send_batch_delay_ms = 0
         super().send_str(msg, delay_ms)
 
     def check_calibrated(self) -> None:
@@ -163,17 +248,14 @@ class BalanceController(SerialController):  # separate controller thread
 
     def reset(self) -> None:
         self.info("Balance resetting")
-        self.recent_measurements_kg = []
+        self.clear_recent_measurements()
         baud = self.balance_config.baudrate
         parity = self.balance_config.parity
-        if parity == serial.PARITY_NONE:
-            parity_code = 0
-        elif parity == serial.PARITY_EVEN:
-            parity_code = 1
-        else:
+        parity_code = PARITY_TO_CODE.get(parity)
+        if parity_code is None:
             self.error("Invalid parity ({})! Choosing even parity. "
-                       "COMMUNICATION MAY BREAK.")
-            parity_code = 1
+                       "COMMUNICATION MAY BREAK.".format(parity))
+            parity_code = PARITY_TO_CODE[serial.PARITY_EVEN]
 
         self.send(CMD_NO_OP, reply_expected=False)  # cancel anything ongoing
         self.send(CMD_STOP_MEASURING, reply_expected=False)
@@ -214,17 +296,18 @@ class BalanceController(SerialController):  # separate controller thread
 
     def start_measuring(self) -> None:
         self.n_pending_measurements += self.measurements_per_batch
-        # noinspection PyTypeChecker
-        self.send(CMD_QUERY_MEASURE, self.measurements_per_batch)
-        self.command_queue.extend(
-            [CMD_QUERY_MEASURE] * (self.measurements_per_batch - 1))
-
-    def read_until(self, when_to_read_until: arrow.Arrow) -> None:
-        self.rfid_event_expires = when_to_read_until
-        now = arrow.now()
+        self.send(CMD_QUERY_MEASURE, self.measure_batch_params)
+        self.command_queue.extend(self.measure_queue_extension)
+
+    def extend_read_until(self, when_to_read_until: float) -> None:
+        # when_to_read_until is on the time.monotonic() clock.
+        # Never shorten the window if RFID events overlap.
+        if when_to_read_until > self.rfid_event_expires:
+            self.rfid_event_expires = when_to_read_until
         if self.balance_config.read_continuously:
             return  # already measuring
-        if self.n_pending_measurements == 0 and now < self.rfid_event_expires:
+        if (self.n_pending_measurements == 0 and
+                time.monotonic() < self.rfid_event_expires):
             self.start_measuring()
 
     @pyqtSlot()
@@ -259,14 +342,15 @@ class BalanceController(SerialController):  # separate controller thread
 
     def stop_measuring(self):
         self.send(CMD_STOP_MEASURING, reply_expected=False)
-        self.command_queue = [x for x in self.command_queue
-                              if x != CMD_QUERY_MEASURE]
+        self.command_queue = deque(x for x in self.command_queue
+                                   if x != CMD_QUERY_MEASURE)
         self.n_pending_measurements = 0
 
     @pyqtSlot()
     @exit_on_exception
     def on_stop(self) -> None:
         self.stop_measuring()
+        self.flush_sends()  # we won't get another event loop turn
         self.finished.emit()
         # Inelegant! Risk the writer thread will be terminated before it
         # sends this command. Still, ho-hum.
@@ -275,39 +359,76 @@ class BalanceController(SerialController):  # separate controller thread
         self.status("Currently scanning" if self.n_pending_measurements > 0
                     else "Not currently scanning")
 
-    def value_to_mass(self, value: int) -> Optional[float]:
+    def update_calibration_scale(self) -> None:
+        """
+        Precalculates what value_to_mass() needs from the calibration. Call
+        whenever the calibration changes.
+        """
         r = self.balance_config.refload_value
         z = self.balance_config.zero_value
         m = self.balance_config.refload_mass_kg
-        if None in [r, z, m]:
+        if r is None or z is None or m is None or r == z:
+            self.kg_per_unit = None
+        else:
+            self.kg_per_unit = m / (r - z)
+
+    def value_to_mass(self, value: int) -> Optional[float]:
+        if self.kg_per_unit is None:
             return None
-        return m * (value - z) / (r - z)
+        return self.kg_per_unit * (value - self.balance_config.zero_value)
+
+    def clear_recent_measurements(self) -> None:
+        self.recent_measurements_kg = deque(
+            maxlen=self.balance_config.stability_n)
+        # Sliding-window minimum/maximum: (index, mass_kg) tuples for the
+        # measurements that could still become the window's min (max), in
+        # index order, with increasing (decreasing) mass; the current
+        # min (max) is at the left.
+        self.recent_min_kg = deque()
+        self.recent_max_kg = deque()
+
+    def add_recent_measurement(self, mass_kg: float) -> None:
+        index = self.n_measurements
+        self.n_measurements += 1
+        self.recent_measurements_kg.append(mass_kg)  # oldest drops off
+        oldest_index = index - self.balance_config.stability_n + 1
+        mins = self.recent_min_kg
+        while mins and mins[-1][1] >= mass_kg:
+            mins.pop()
+        mins.append((index, mass_kg))
+        if mins[0][0] < oldest_index:
+            mins.popleft()
+        maxes = self.recent_max_kg
+        while maxes and maxes[-1][1] <= mass_kg:
+            maxes.pop()
+        maxes.append((index, mass_kg))
+        if maxes[0][0] < oldest_index:
+            maxes.popleft()
 
     def is_stable(self) -> bool:
         # Do we have a stable mass?
         if len(self.recent_measurements_kg) < self.balance_config.stability_n:
             # ... not enough measurements to judge
             return False
-        min_kg = min(self.recent_measurements_kg)
-        max_kg = max(self.recent_measurements_kg)
+        min_kg = self.recent_min_kg[0][1]
+        max_kg = self.recent_max_kg[0][1]
         range_kg = max_kg - min_kg
         if range_kg > self.balance_config.tolerance_kg:
             return False
         # Stable.
         return True
 
-    def process_value(self, value: int, timestamp: arrow.Arrow) -> None:
+    def process_value(self, value: int, timestamp: arrow.Arrow,
+                      received_monotonic: float) -> None:
         mass_kg = self.value_to_mass(value)
         if mass_kg is None:
             self.debug("Balance uncalibrated; ignoring value")
             return
-        self.debug("BALANCE VALUE: {} => {} kg".format(
-            value, GUI_MASS_FORMAT % mass_kg))
-        while (len(self.recent_measurements_kg) >=
-                self.balance_config.stability_n):
-            self.recent_measurements_kg.pop(0)
-        self.recent_measurements_kg.append(mass_kg)
-        rfid_valid = timestamp < self.rfid_event_expires
+        if self.debug_enabled():
+            self.debug("BALANCE VALUE: {} => {} kg".format(
+                value, GUI_MASS_FORMAT % mass_kg))
+        self.add_recent_measurement(mass_kg)
+        rfid_valid = received_monotonic < self.rfid_event_expires
         rfid = self.rfid_event_rfid if rfid_valid else None
         identified = rfid is not None
         stable = self.is_stable()
@@ -335,7 +456,8 @@ class BalanceController(SerialController):  # separate controller thread
         self.mass_received.emit(mass_event)
 
     def tare_with(self, value: int) -> None:
-        self.debug("tare_with: {}".format(value))
+        if self.debug_enabled():
+            self.debug("tare_with: {}".format(value))
         self.pending_tare = False
         if value == self.balance_config.zero_value:
             return  # No change
@@ -349,7 +471,8 @@ class BalanceController(SerialController):  # separate controller thread
         self.finish_calibration()
 
     def calibrate_with(self, value: int) -> None:
-        self.debug("calibrate_with: {}".format(value))
+        if self.debug_enabled():
+            self.debug("calibrate_with: {}".format(value))
         self.pending_calibrate = False
         if value == self.balance_config.refload_value:
             return  # no change
@@ -360,6 +483,7 @@ class BalanceController(SerialController):  # separate controller thread
         if self.balance_config.refload_value == self.balance_config.zero_value:
             # would cause division by zero
             self.balance_config.refload_value = None
+        self.update_calibration_scale()
         report = CalibrationReport(
             balance_id=self.balance_config.id,
             balance_name=self.balance_config.name,
@@ -376,11 +500,12 @@ class BalanceController(SerialController):  # separate controller thread
         if not isinstance(rfid_event, RfidEvent):
             self.critical("Bad rfid_event: {}".format(rfid_event))
             return
-        rfid_event_expires = rfid_event.timestamp + datetime.timedelta(
-            seconds=self.rfid_effective_time_s)  # type: arrow.Arrow
-        # ... an Arrow plus a timedelta gives an Arrow
+        # Work on the monotonic clock from here on, allowing for however long
+        # the event took to reach us.
+        rfid_event_expires = (monotonic_time_of(rfid_event.timestamp) +
+                              self.rfid_effective_time_s)
         self.rfid_event_rfid = rfid_event.rfid
-        self.read_until(rfid_event_expires)
+        self.extend_read_until(rfid_event_expires)
 
     @pyqtSlot(str, arrow.Arrow)
     def on_receive(self, data: str, timestamp: arrow.Arrow) -> None:
@@ -390,78 +515,24 @@ class BalanceController(SerialController):  # separate controller thread
         if not isinstance(timestamp, arrow.Arrow):
             self.critical("bad timestamp: {}".format(repr(timestamp)))
             return
-        gre = CompiledRegexMemory()
         if self.command_queue:
-            cmd = self.command_queue.pop(0)
+            cmd = self.command_queue.popleft()
         else:
             cmd = None
-        self.debug("Balance receiving at {}: {} (most recent command was: "
-                   "{})".format(timestamp, repr(data), cmd))
+        if self.debug_enabled():
+            self.debug("Balance receiving at {}: {} (most recent command "
+                       "was: {})".format(timestamp, repr(data), cmd))
         # self.debug("len(self.command_queue) %d" % len(self.command_queue))
 
         if cmd == CMD_QUERY_MEASURE:
-            try:
-                value = int(data)
-                if self.pending_tare:
-                    self.tare_with(value)
-                elif self.pending_calibrate:
-                    self.calibrate_with(value)
-                else:
-                    self.process_value(value, timestamp)
-            except ValueError:
-                self.error("Balance sent a bad value")
-            self.n_pending_measurements -= 1
-            self.debug("n_pending_measurements: {}".format(
-                self.n_pending_measurements))
-            if (self.n_pending_measurements == 0 and
-                    (self.balance_config.read_continuously or
-                        self.locked or
-                        timestamp < self.rfid_event_expires)):
-                self.debug("Finished measuring; restarting")
-                self.start_measuring()
-        elif (cmd in [CMD_QUERY_BAUD_RATE, CMD_SET_BAUD_RATE] and
-                gre.match(BAUDRATE_REGEX, data)):
-            baudrate = int(gre.group(1))
-            parity_code = int(gre.group(2))
-            if parity_code == 1:
-                parity = 'E'
-            elif parity_code == 0:
-                parity = 'N'
-            else:
-                parity = '?'
-            self.status("Balance is using {} bps, parity {}".format(baudrate,
-                                                                    parity))
-        elif (data == RESPONSE_NONSPECIFIC_OK and
-                cmd in [
-                    CMD_ASCII_RESULT_OUTPUT,
-                    CMD_DATA_DELIMITER_COMMA_CR_LF,
-                    CMD_FILTER_TYPE,
-                    CMD_MEASUREMENT_RATE,
-                    CMD_SET_BAUD_RATE,
-                    CMD_SET_FILTER,
-                    CMD_TARE,
-                ]):
+            # By far the commonest reply; skip the general dispatch.
+            self.on_measure_reply(data, timestamp)
+            return
+        handler = self.reply_handlers.get(cmd)
+        if handler is not None and handler(data, timestamp):
+            return
+        if data == RESPONSE_NONSPECIFIC_OK and cmd in OK_ACK_COMMANDS:
             self.status("Balance acknowledges command {}".format(cmd))
-        elif cmd == CMD_QUERY_STATUS:
-            self.status("Balance status: {}".format(data))
-            # noinspection PyBroadException
-            try:
-                bits = bitstring.BitStream(uint=int(data), length=6)
-                command_error, execution_error, hardware_error = (
-                    bits.readlist('bool, bool, bool, pad:3'))
-                self.status(
-                    "command_error={}, execution_error={}, "
-                    "hardware_error={}".format(command_error, execution_error,
-                                               hardware_error))
-            except:
-                self.status("Can't interpret status")
-        elif cmd == CMD_QUERY_IDENTIFICATION:
-            self.status("Balance identification: {}".format(data))
-        elif cmd == CMD_QUERY_OUTPUT_SCALING:
-            try:
-                self.max_value = int(data)
-            except ValueError:
-                self.error("Bad value received")
         elif data == RESPONSE_UNKNOWN:
             self.status("Balance says 'eh?'")
         else:
@@ -469,6 +540,81 @@ class BalanceController(SerialController):  # separate controller thread
                 "Unknown message from balance: {} (for command: {})".format(
                     repr(data), repr(cmd)))
 
+    # -------------------------------------------------------------------------
+    # Reply handlers, by command. Those in reply_handlers return True if the
+    # reply was dealt with; MSV? replies always are.
+    # -------------------------------------------------------------------------
+
+    def on_measure_reply(self, data: str, timestamp: arrow.Arrow) -> None:
+        # As before, judge the RFID window by when the sample arrived, not by
+        # when we get round to processing it.
+        received_monotonic = monotonic_time_of(timestamp)
+        value = parse_int(data)
+        if value is None:
+            self.error("Balance sent a bad value")
+        elif self.pending_tare:
+            self.tare_with(value)
+        elif self.pending_calibrate:
+            self.calibrate_with(value)
+        else:
+            self.process_value(value, timestamp, received_monotonic)
+        self.n_pending_measurements -= 1
+        if self.debug_enabled():
+            self.debug("n_pending_measurements: {}".format(
+                self.n_pending_measurements))
+        if (self.n_pending_measurements == 0 and
+                (self.balance_config.read_continuously or
+                    self.locked or
+                    received_monotonic < self.rfid_event_expires)):
+            if self.debug_enabled():
+                self.debug("Finished measuring; restarting")
+            self.start_measuring()
+
+    # noinspection PyUnusedLocal
+    def on_baud_rate_reply(self, data: str, timestamp: arrow.Arrow) -> bool:
+        m = BAUDRATE_REGEX.match(data)
+        if not m:
+            return False  # e.g. plain acknowledgement of BDR
+        baudrate = int(m.group(1))
+        parity_code = int(m.group(2))
+        parity = CODE_TO_PARITY.get(parity_code, '?')
+        self.status("Balance is using {} bps, parity {}".format(baudrate,
+                                                                parity))
+        return True
+
+    # noinspection PyUnusedLocal
+    def on_status_reply(self, data: str, timestamp: arrow.Arrow) -> bool:
+        self.status("Balance status: {}".format(data))
+        status = parse_int(data)
+        if status is None or not 0 <= status < 64:  # 6-bit value
+            self.status("Can't interpret status")
+        else:
+            # Top three of the six bits, most significant first.
+            command_error = bool(status & 0x20)
+            execution_error = bool(status & 0x10)
+            hardware_error = bool(status & 0x08)
+            self.status(
+                "command_error={}, execution_error={}, "
+                "hardware_error={}".format(command_error, execution_error,
+                                           hardware_error))
+        return True
+
+    # noinspection PyUnusedLocal
+    def on_identification_reply(self, data: str,
+                                timestamp: arrow.Arrow) -> bool:
+        self.status("Balance identification: {}".format(data))
+        return True
+
+    # noinspection PyUnusedLocal
+    def on_output_scaling_reply(self, data: str,
+                                timestamp: arrow.Arrow) -> bool:
+        value = parse_int(data)
+        if value is None:
+            self.error("Bad value received")
+        else:
+            self.max_value = value
+        return True
+
 
 class BalanceOwner(SerialOwner):  # GUI thread
     # Outwards, to world:
@@ -511,9 +657,12 @@ class BalanceOwner(SerialOwner):  # GUI thread
         self.tare_requested.connect(self.controller.tare)
         self.calibration_requested.connect(self.controller.calibrate)
 
-        self.on_rfid.connect(self.controller.on_rfid)  # different thread
-        self.controller.mass_received.connect(self.mass_received)  # different thread  # noqa
-        self.controller.calibrated.connect(self.calibrated)  # different thread
+        # Different threads:
+        self.on_rfid.connect(self.controller.on_rfid, Qt.QueuedConnection)
+        self.controller.mass_received.connect(self.mass_received,
+                                              Qt.QueuedConnection)
+        self.controller.calibrated.connect(self.calibrated,
+                                           Qt.QueuedConnection)
 
     def ping(self) -> None:
         self.ping_requested.emit()
@@ -18,10 +18,12 @@
 """
 
 import collections
+import functools
+import itertools
 import logging
 import platform
 import traceback
-from typing import List
+from typing import Any, Callable, Iterable, List, Sequence, Tuple
 
 import arrow
 from PyQt5.QtCore import QObject, Qt, pyqtSignal, pyqtSlot
@@ -387,7 +389,9 @@ class BaseWindow(QMainWindow):  # GUI thread
             # -----------------------------------------------------------------
             # Whisker
             # -----------------------------------------------------------------
-            self.whisker_task = WeightWhiskerTask(wcm_prefix=config.wcm_prefix)
+            self.whisker_task = WeightWhiskerTask(
+                wcm_prefix=config.wcm_prefix,
+                rfid_effective_time_s=config.rfid_effective_time_s)
             self.whisker_owner = WhiskerOwner(  # GUI thread
                 self.whisker_task, config.server, parent=self)
             self.whisker_owner.finished.connect(self.something_finished)
@@ -865,8 +869,11 @@ class MasterConfigWindow(QDialog, TransactionalEditDialogMixin):
         self.rfid_lv = ModalEditListView(session, RfidConfigDialog,
                                          readonly=readonly)
         self.rfid_lv.selected_maydelete.connect(self.set_rfid_button_states)
-        self.balance_lv = ModalEditListView(session, BalanceConfigDialog,
-                                            readonly=readonly)
+        self.balance_lv = ModalEditListView(
+            session,
+            functools.partial(BalanceConfigDialog,
+                              get_readers=self.get_enabled_readers),
+            readonly=readonly)
         self.balance_lv.selected_maydelete.connect(
             self.set_balance_button_states)
 
@@ -932,6 +939,11 @@ class MasterConfigWindow(QDialog, TransactionalEditDialogMixin):
         # Pass in data
         self.object_to_dialog(self.obj)
 
+    def get_enabled_readers(self) -> List[RfidReaderConfig]:
+        # The readers we're editing, including any not yet saved; no need to
+        # go back to the database.
+        return [r for r in self.obj.rfidreader_configs if r.enabled]
+
     def object_to_dialog(self, obj: MasterConfig) -> None:
         self.rfid_effective_time_edit.setText(str(
             obj.rfid_effective_time_s
@@ -954,48 +966,44 @@ class MasterConfigWindow(QDialog, TransactionalEditDialogMixin):
         try:
             obj.rfid_effective_time_s = float(
                 self.rfid_effective_time_edit.text())
-            assert obj.rfid_effective_time_s > 0
-        except:
+        except ValueError:
             raise ValidationError("Invalid RFID effective time")
-        try:
-            obj.server = self.server_edit.text()
-            assert len(obj.server) > 0
-        except:
+        if not (obj.rfid_effective_time_s > 0):  # also rejects NaN
+            raise ValidationError("Invalid RFID effective time")
+        obj.server = self.server_edit.text()
+        if not obj.server:
             raise ValidationError("Invalid server name")
         try:
             obj.port = int(self.port_edit.text())
-            assert obj.port > 0
-        except:
+        except ValueError:
+            raise ValidationError("Invalid port number")
+        if obj.port <= 0:
             raise ValidationError("Invalid port number")
         # ---------------------------------------------------------------------
         # Duplicate device ports, or names?
         # ---------------------------------------------------------------------
-        name_port_pairs = (
-            [(r.name, r.port) for r in obj.rfidreader_configs] +
-            [(b.name, b.port) for b in obj.balance_configs]
-        )
-        names = [x[0] for x in name_port_pairs]
-        # noinspection PyArgumentList
-        duplicate_names = [
-            item for item, count in collections.Counter(names).items()
-            if count > 1
-        ]
+        # Windows is case-insensitive; e.g. com1, COM1
+        ports_case_insensitive = platform.system() == 'Windows'
+        name_counts = collections.Counter()
+        port_to_names = collections.defaultdict(list)
+        for device in itertools.chain(obj.rfidreader_configs,
+                                      obj.balance_configs):
+            name_counts[device.name] += 1
+            port = device.port
+            if ports_case_insensitive:
+                port = port.upper()
+            port_to_names[port].append(device.name)
+        duplicate_names = [name for name, count in name_counts.items()
+                           if count > 1]
         if duplicate_names:
             raise ValidationError(
                 "Devices have duplicate names!<br>"
                 "Names: {}.".format(duplicate_names))
-        ports = [x[1] for x in name_port_pairs]
-        if platform.system() == 'Windows':
-            # Windows is case-insensitive; e.g. com1, COM1
-            ports = [x.upper() for x in ports]
-        # noinspection PyArgumentList
-        duplicate_ports = [
-            item for item, count in collections.Counter(ports).items()
-            if count > 1
-        ]
-        names_of_duplicate_ports = [x[0] for x in name_port_pairs
-                                    if x[1] in duplicate_ports]
+        duplicate_ports = [port for port, names in port_to_names.items()
+                           if len(names) > 1]
         if duplicate_ports:
+            names_of_duplicate_ports = [name for port in duplicate_ports
+                                        for name in port_to_names[port]]
             raise ValidationError(
                 "More than one device on a single serial port!<br>"
                 "Names: {}.<br>Ports: {}".format(names_of_duplicate_ports,
@@ -1004,7 +1012,7 @@ class MasterConfigWindow(QDialog, TransactionalEditDialogMixin):
         # ---------------------------------------------------------------------
         # Balances without a paired RFID, or with duplicate pairs?
         # ---------------------------------------------------------------------
-        used_reader_names = []
+        used_reader_names = set()
         for balance_config in obj.balance_configs:
             if balance_config.reader is None:
                 raise ValidationError(
@@ -1020,7 +1028,7 @@ class MasterConfigWindow(QDialog, TransactionalEditDialogMixin):
                 raise ValidationError(
                     "More than one balance is trying to use reader {}".format(
                         balance_config.reader.name))
-            used_reader_names.append(balance_config.reader.name)
+            used_reader_names.add(balance_config.reader.name)
 
     @pyqtSlot()
     def add_rfid(self) -> None:
@@ -1066,15 +1074,55 @@ class MasterConfigWindow(QDialog, TransactionalEditDialogMixin):
 # Dialog components for serial config
 # =============================================================================
 
+# (value, label) options for RadioGroup
+SERIAL_BYTESIZE_MAP = (
+    (serial.FIVEBITS, "&5"),
+    (serial.SIXBITS, "&6"),
+    (serial.SEVENBITS, "&7"),
+    (serial.EIGHTBITS, "&8"),
+)
+SERIAL_PARITY_MAP = (
+    (serial.PARITY_NONE, "&None"),
+    (serial.PARITY_EVEN, "&Even"),
+    (serial.PARITY_ODD, "&Odd"),
+    (serial.PARITY_MARK, "Mark (rare)"),
+    (serial.PARITY_SPACE, "Space (rare)"),
+)
+SERIAL_STOPBITS_MAP = (
+    (serial.STOPBITS_ONE, "&1"),
+    (serial.STOPBITS_ONE_POINT_FIVE, "1.5 (rare)"),
+    (serial.STOPBITS_TWO, "&2"),
+)
+
+
+def filter_option_map(
+        option_map: Sequence[Tuple[Any, str]],
+        allowed: Iterable[Any] = None) -> Sequence[Tuple[Any, str]]:
+    """
+    Restricts a (value, label) map to the allowed values, if any are given.
+    """
+    if not allowed:
+        return option_map
+    allowed = frozenset(allowed)
+    return [x for x in option_map if x[0] in allowed]
+
+
 class SerialPortMixin(object):
     FLOW_NONE = 0
     FLOW_XONXOFF = 1
     FLOW_RTSCTS = 2
     FLOW_DTRDSR = 3
+    FLOW_MAP = (
+        (FLOW_NONE, "None (not advised)"),
+        (FLOW_XONXOFF, "&XON/XOFF software flow control"),
+        (FLOW_RTSCTS, "&RTS/CTS hardware flow control"),
+        (FLOW_DTRDSR, "&DTR/DSR hardware flow control"),
+    )
 
     def __init__(self,
                  port_options: List[str] = None,
                  allow_other_port: bool = True,
+                 refresh_port_options: Callable[[], List[str]] = None,
                  baudrate_options: List[int] = None,
                  allow_other_baudrate: bool = False,
                  bytesize_options: List[int] = None,
@@ -1086,57 +1134,36 @@ class SerialPortMixin(object):
         Always helpful to have allow_other_port=True on Linux, because you can
         create new debugging ports at the drop of a hat, and the serial port
         enumerator may not notice.
+
+        If refresh_port_options is given (and port_options is non-empty),
+        there's a button to call it to re-fetch the list of ports.
         """
         super().__init__(**kwargs)
         self.sp_port_options = port_options
+        self.sp_port_is_combo = bool(port_options)
+        self.sp_refresh_port_options = refresh_port_options
         self.sp_allow_other_port = allow_other_port
         self.sp_baudrate_options = baudrate_options
         self.sp_allow_other_baudrate = allow_other_baudrate
 
-        bytesize_map = [
-            (serial.FIVEBITS, "&5"),
-            (serial.SIXBITS, "&6"),
-            (serial.SEVENBITS, "&7"),
-            (serial.EIGHTBITS, "&8"),
-        ]
-        if bytesize_options:
-            bytesize_map = [x for x in bytesize_map
-                            if x[0] in bytesize_options]
-
-        parity_map = [
-            (serial.PARITY_NONE, "&None"),
-            (serial.PARITY_EVEN, "&Even"),
-            (serial.PARITY_ODD, "&Odd"),
-            (serial.PARITY_MARK, "Mark (rare)"),
-            (serial.PARITY_SPACE, "Space (rare)"),
-        ]
-        if parity_options:
-            parity_map = [x for x in parity_map if x[0] in parity_options]
-
-        stopbits_map = [
-            (serial.STOPBITS_ONE, "&1"),
-            (serial.STOPBITS_ONE_POINT_FIVE, "1.5 (rare)"),
-            (serial.STOPBITS_TWO, "&2"),
-        ]
-        if stopbits_options:
-            stopbits_map = [x for x in stopbits_map
-                            if x[0] in stopbits_options]
-
-        flow_map = [
-            (self.FLOW_NONE, "None (not advised)"),
-            (self.FLOW_XONXOFF, "&XON/XOFF software flow control"),
-            (self.FLOW_RTSCTS, "&RTS/CTS hardware flow control"),
-            (self.FLOW_DTRDSR, "&DTR/DSR hardware flow control"),
-        ]
-        if flow_options:
-            flow_map = [x for x in flow_map if x[0] in flow_options]
+        bytesize_map = filter_option_map(SERIAL_BYTESIZE_MAP, bytesize_options)
+        parity_map = filter_option_map(SERIAL_PARITY_MAP, parity_options)
+        stopbits_map = filter_option_map(SERIAL_STOPBITS_MAP, stopbits_options)
+        flow_map = filter_option_map(self.FLOW_MAP, flow_options)
 
         form = QFormLayout()
-        if self.sp_port_options:
+        if self.sp_port_is_combo:
             self.sp_port_combo = QComboBox()
             self.sp_port_combo.setEditable(allow_other_port)
             self.sp_port_combo.addItems(port_options)
-            sp_port_thing = self.sp_port_combo
+            if refresh_port_options:
+                sp_refresh_button = QPushButton("Refresh")
+                sp_refresh_button.clicked.connect(self.sp_refresh_ports)
+                sp_port_thing = QHBoxLayout()
+                sp_port_thing.addWidget(self.sp_port_combo, 1)
+                sp_port_thing.addWidget(sp_refresh_button)
+            else:
+                sp_port_thing = self.sp_port_combo
         else:
             self.sp_port_edit = QLineEdit()
             sp_port_thing = self.sp_port_edit
@@ -1193,22 +1220,32 @@ class SerialPortMixin(object):
         self.sp_group = StyledQGroupBox('Serial port settings')
         self.sp_group.setLayout(vlayout)
 
+    def sp_refresh_ports(self) -> None:
+        current = self.sp_port_combo.currentText()
+        self.sp_port_options = self.sp_refresh_port_options()
+        self.sp_port_combo.clear()
+        self.sp_port_combo.addItems(self.sp_port_options)
+        if current in self.sp_port_options:
+            self.sp_port_combo.setCurrentIndex(
+                self.sp_port_options.index(current))
+        elif self.sp_allow_other_port:
+            self.sp_port_combo.setEditText(current)
+
     def serial_port_group_to_object(self, obj: SerialPortConfigMixin) -> None:
-        try:
-            if self.sp_port_options:
-                obj.port = self.sp_port_combo.currentText()
-            else:
-                obj.port = self.sp_port_edit.text()
-            assert len(obj.port) > 0
-        except:
+        if self.sp_port_is_combo:
+            obj.port = self.sp_port_combo.currentText()
+        else:
+            obj.port = self.sp_port_edit.text()
+        if not obj.port:
             raise ValidationError("Invalid serial port name")
         try:
             if self.sp_baudrate_options:
                 obj.baudrate = int(self.sp_baudrate_combo.currentText())
             else:
                 obj.baudrate = int(self.sp_baudrate_edit.text())
-            assert obj.baudrate > 0
-        except:
+        except ValueError:
+            raise ValidationError("Invalid speed")
+        if obj.baudrate <= 0:
             raise ValidationError("Invalid speed")
         obj.bytesize = self.sp_bytesize_rg.get_value()
         obj.parity = self.sp_parity_rg.get_value()
@@ -1219,7 +1256,7 @@ class SerialPortMixin(object):
         obj.dsrdtr = flow == self.FLOW_DTRDSR
 
     def object_to_serial_port_group(self, obj: SerialPortConfigMixin) -> None:
-        if self.sp_port_options:
+        if self.sp_port_is_combo:
             if obj.port in self.sp_port_options:
                 index = self.sp_port_options.index(obj.port)
                 self.sp_port_combo.setCurrentIndex(index)
@@ -1256,11 +1293,24 @@ class SerialPortMixin(object):
 # =============================================================================
 # Get available serial ports
 # =============================================================================
-# Do it live, in case they change live.
+# Enumerating ports can be slow (notably under Windows), so we do it once, the
+# first time a dialog needs it, and again only when the user asks (via the
+# "Refresh" button), in case they change live.
+
+_available_serial_ports = None  # type: List[str]
+
+
+def get_available_serial_ports(refresh: bool = False) -> List[str]:
+    global _available_serial_ports
+    if _available_serial_ports is None or refresh:
+        _available_serial_ports = sorted(
+            [item[0] for item in comports()], key=natural_keys)
+        # comports() returns a list/tuple of tuples: (port, desc, hwid)
+    return list(_available_serial_ports)
 
-def get_available_serial_ports() -> List[str]:
-    return sorted([item[0] for item in comports()], key=natural_keys)
-    # comports() returns a list/tuple of tuples: (port, desc, hwid)
+
+def refresh_available_serial_ports() -> List[str]:
+    return get_available_serial_ports(refresh=True)
 
 
 # =============================================================================
@@ -1280,6 +1330,7 @@ class RfidConfigDialog(QDialog, TransactionalEditDialogMixin,
         super().__init__(
             # for SerialPortMixin       [3]
             port_options=get_available_serial_ports(),
+            refresh_port_options=refresh_available_serial_ports,
             baudrate_options=[9600],
             bytesize_options=[serial.EIGHTBITS],
             parity_options=[serial.PARITY_NONE],
@@ -1332,10 +1383,8 @@ class RfidConfigDialog(QDialog, TransactionalEditDialogMixin,
 
     def dialog_to_object(self, obj: RfidReaderConfig) -> None:
         obj.enabled = self.enabled_group.isChecked()
-        try:
-            obj.name = self.name_edit.text()
-            assert len(obj.name) > 0
-        except:
+        obj.name = self.name_edit.text()
+        if not obj.name:
             raise ValidationError("Invalid name")
         self.serial_port_group_to_object(obj)
 
@@ -1352,11 +1401,18 @@ class BalanceConfigDialog(QDialog, TransactionalEditDialogMixin,
                  balance_config: BalanceConfig,
                  parent: QObject = None,
                  readonly: bool = False,
+                 get_readers: Callable[[], List[RfidReaderConfig]] = None,
                  **kwargs):
+        """
+        get_readers, if specified, provides the RFID readers that the balance
+        may be paired with; otherwise, we fetch enabled readers from the
+        database.
+        """
         top_layout = QVBoxLayout()
         super().__init__(
             # for SerialPortMixin   [4]
             port_options=get_available_serial_ports(),
+            refresh_port_options=refresh_available_serial_ports,
             baudrate_options=[1200, 2400, 4800, 9600, 19200, 38400],
             bytesize_options=[serial.EIGHTBITS],
             parity_options=[serial.PARITY_NONE, serial.PARITY_EVEN],
@@ -1378,11 +1434,14 @@ class BalanceConfigDialog(QDialog, TransactionalEditDialogMixin,
         # interface is RS-485, 2-wire, half-duplex (p4, 5).
 
         reader_map = []
-        readers = (
-            session.query(RfidReaderConfig)
-            .filter(RfidReaderConfig.enabled == True)  # http://stackoverflow.com/questions/18998010  # noqa
-            .all()
-        )
+        if get_readers is not None:
+            readers = get_readers()
+        else:
+            readers = (
+                session.query(RfidReaderConfig)
+                .filter(RfidReaderConfig.enabled == True)  # http://stackoverflow.com/questions/18998010  # noqa
+                .all()
+            )
         for reader in readers:
             reader_map.append((reader.id, reader.name))
         if reader_map:
@@ -1391,6 +1450,7 @@ class BalanceConfigDialog(QDialog, TransactionalEditDialogMixin,
         else:
             self.reader_ids = []
             self.reader_names = []
+        self.reader_name_to_id = dict(zip(self.reader_names, self.reader_ids))
 
         self.setWindowTitle("Configure balance")
 
@@ -1495,53 +1555,57 @@ class BalanceConfigDialog(QDialog, TransactionalEditDialogMixin,
 
     def dialog_to_object(self, obj: BalanceConfig) -> None:
         obj.enabled = self.enabled_group.isChecked()
-        try:
-            obj.name = self.name_edit.text()
-            assert len(obj.name) > 0
-        except:
+        obj.name = self.name_edit.text()
+        if not obj.name:
             raise ValidationError("Invalid name")
         reader_name = self.reader_combo.currentText()
         try:
-            reader_index = self.reader_names.index(reader_name)
-            obj.reader_id = self.reader_ids[reader_index]
-        except:
+            obj.reader_id = self.reader_name_to_id[reader_name]
+        except KeyError:
             raise ValidationError("Invalid reader")
         try:
             obj.measurement_rate_hz = int(
                 self.measurement_rate_hz_combo.currentText())
-            assert obj.measurement_rate_hz in POSSIBLE_RATES_HZ
-        except:
+        except ValueError:
+            raise ValidationError("Invalid measurement_rate_hz")
+        if obj.measurement_rate_hz not in POSSIBLE_RATES_HZ:
             raise ValidationError("Invalid measurement_rate_hz")
         try:
             obj.amp_signal_filter_mode = int(self.asf_combo.currentText())
-            assert obj.amp_signal_filter_mode in POSSIBLE_ASF_MODES
-        except:
+        except ValueError:
+            raise ValidationError("Invalid amp_signal_filter_mode")
+        if obj.amp_signal_filter_mode not in POSSIBLE_ASF_MODES:
             raise ValidationError("Invalid amp_signal_filter_mode")
         obj.fast_response_filter = self.fast_filter_check.isChecked()
         try:
             obj.stability_n = int(self.stability_n_edit.text())
-            assert obj.stability_n > 1
-        except:
+        except ValueError:
+            raise ValidationError("Invalid stability_n")
+        if obj.stability_n <= 1:
             raise ValidationError("Invalid stability_n")
         try:
             obj.tolerance_kg = float(self.tolerance_kg_edit.text())
-            assert obj.tolerance_kg > 0
-        except:
+        except ValueError:
+            raise ValidationError("Invalid tolerance_kg")
+        if not (obj.tolerance_kg > 0):  # also rejects NaN
             raise ValidationError("Invalid tolerance_kg")
         try:
             obj.min_mass_kg = float(self.min_mass_kg_edit.text())
-            assert obj.min_mass_kg > 0
-        except:
+        except ValueError:
+            raise ValidationError("Invalid min_mass_kg")
+        if not (obj.min_mass_kg > 0):  # also rejects NaN
             raise ValidationError("Invalid min_mass_kg")
         try:
             obj.unlock_mass_kg = float(self.unlock_mass_kg_edit.text())
-            assert obj.unlock_mass_kg > 0
-        except:
+        except ValueError:
+            raise ValidationError("Invalid unlock_mass_kg")
+        if not (obj.unlock_mass_kg > 0):  # also rejects NaN
             raise ValidationError("Invalid unlock_mass_kg")
         try:
             obj.refload_mass_kg = float(self.refload_mass_kg_edit.text())
-            assert obj.refload_mass_kg > 0
-        except:
+        except ValueError:
+            raise ValidationError("Invalid refload_mass_kg")
+        if not (obj.refload_mass_kg > 0):  # also rejects NaN
             raise ValidationError("Invalid refload_mass_kg")
         obj.read_continuously = self.read_continuously_check.isChecked()
         self.serial_port_group_to_object(obj)
@@ -35,7 +35,7 @@ import traceback
 from PyQt5.Qt import PYQT_VERSION_STR
 from PyQt5.QtCore import QT_VERSION_STR
 from PyQt5.QtWidgets import QApplication
-from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 # from whisker.debug_qt import enable_signal_debugging_simply
 from whisker.logging import (
     configure_logger_for_colour,
@@ -68,9 +68,11 @@ from starfeeder.gui import (
     WrongDatabaseVersionWindow,
 )
 from starfeeder.settings import (
+    enable_sqlite_pragmas,
     get_database_url,
     set_database_url,
     set_database_echo,
+    set_database_wal,
 )
 from starfeeder.version import VERSION
 
@@ -107,6 +109,10 @@ def main() -> int:
         "environment variable).".format(DB_URL_ENV_VAR))
     parser.add_argument('--dbecho', action="store_true",
                         help="Echo SQL to log.")
+    parser.add_argument('--no-wal', action="store_true",
+                        help="Don't use write-ahead logging for SQLite "
+                        "databases (use this if the database is on a network "
+                        "drive).")
     parser.add_argument('--debug-qt-signals', action="store_true",
                         help="Debug QT signals.")
 
@@ -197,6 +203,8 @@ def main() -> int:
             set_database_url(args.dburl)
         if args.dbecho:
             set_database_echo(args.dbecho)
+        if args.no_wal:
+            set_database_wal(False)
         try:
             database_url = get_database_url()
         except ValueError:
@@ -207,8 +215,9 @@ def main() -> int:
                     win.exit_kill_log.connect(log_window.exit)
                 return run_gui(qt_app, win)
             raise ValueError(DATABASE_ENV_VAR_NOT_SPECIFIED)
-        engine = create_engine(database_url)
-        log.debug("Using database URL: {}".format(engine))  # obscures password
+        enable_sqlite_pragmas()
+        log.debug("Using database URL: {!r}".format(make_url(database_url)))
+        # ... repr() of a URL obscures the password
 
         # Has the user requested a command-line database upgrade?
         if args.upgrade_database:
@@ -391,7 +391,7 @@ class RfidEventRecord(SqlAlchemyAttrDictMixin, Base):
     @classmethod
     def record_rfid_detection(
             cls, session: Session, rfid_single_event: RfidEvent,
-            rfid_effective_time_s: float) -> None:
+            rfid_effective_time_s: float, commit: bool = True) -> None:
         if not isinstance(rfid_single_event, RfidEvent):
             log.critical("Bad rfid_event: {}".format(rfid_single_event))
             return
@@ -405,16 +405,19 @@ class RfidEventRecord(SqlAlchemyAttrDictMixin, Base):
         if event:  # one exists already
             event.last_detected_at = rfid_single_event.timestamp
             event.n_events += 1
-        else:  # make a new one
-            event = cls(
+        else:  # make a new one (Core INSERT; no ORM unit-of-work needed)
+            session.execute(RFID_EVENT_INSERT, dict(
                 reader_id=reader_id,
                 rfid=rfid_single_event.rfid,
                 first_detected_at=rfid_single_event.timestamp,
                 last_detected_at=rfid_single_event.timestamp,
                 n_events=1,
-            )
-            session.add(event)
-        session.commit()  # ASAP to unlock database
+            ))
+        if commit:
+            session.commit()  # ASAP to unlock database
+
+
+RFID_EVENT_INSERT = RfidEventRecord.__table__.insert()
 
 
 # While a free-floating ID at a particular reader may be of interest,
@@ -469,21 +472,24 @@ class MassEventRecord(SqlAlchemyAttrDictMixin, Base):
     mass_kg = Column(Float)
 
     @classmethod
-    def record_mass_detection(cls, session: Session,
-                              mass_single_event: MassEvent) -> None:
-        """Returns an OrderedNamespace object, not an SQLAlchemy ORM object."""
-        if not isinstance(mass_single_event, MassEvent):
-            log.critical("Bad mass_single_event: {}".format(mass_single_event))
-            return
-        balance_id = mass_single_event.balance_id
-        # noinspection PyArgumentList
-        mass_identified_event = MassEventRecord(
-            rfid=mass_single_event.rfid,
-            reader_id=mass_single_event.reader_id,
-            balance_id=balance_id,
-            at=mass_single_event.timestamp,
-            mass_kg=mass_single_event.mass_kg,
-        )
-        session.add(mass_identified_event)
-        session.commit()  # ASAP to unlock database
-        # return mass_identified_event.get_attrdict()
+    def record_mass_detections(cls, session: Session,
+                               mass_events: List[MassEvent]) -> None:
+        """
+        Records several mass events with a single multi-row INSERT. Doesn't
+        commit; that's up to the caller.
+        """
+        rows = [
+            dict(
+                rfid=m.rfid,
+                reader_id=m.reader_id,
+                balance_id=m.balance_id,
+                at=m.timestamp,
+                mass_kg=m.mass_kg,
+            )
+            for m in mass_events
+        ]
+        if rows:
+            session.execute(MASS_EVENT_INSERT, rows)
+
+
+MASS_EVENT_INSERT = MassEventRecord.__table__.insert()
@@ -22,7 +22,7 @@ from typing import Optional
 
 import arrow
 import bitstring
-from PyQt5.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal, pyqtSlot
 from whisker.qt import exit_on_exception
 
 from starfeeder.serial_controller import (
@@ -206,7 +206,8 @@ class RfidController(SerialController):
         if not isinstance(timestamp, arrow.Arrow):
             self.critical("bad timestamp: {}".format(repr(timestamp)))
             return
-        self.debug("Receiving at {}: {}".format(timestamp, repr(data)))
+        if self.debug_enabled():
+            self.debug("Receiving at {}: {}".format(timestamp, repr(data)))
         if data == RESPONSE_COMMAND_INVALID:
             self.debug("RESPONSE_COMMAND_INVALID")
             # We might get this because we send CMD_NO_OP_CANCEL either in the
@@ -231,7 +232,8 @@ class RfidController(SerialController):
             if rfid_number is None:
                 self.error("Received unknown data: {}".format(repr(data)))
                 return
-            self.debug("rfid number = {}".format(rfid_number))
+            if self.debug_enabled():
+                self.debug("rfid number = {}".format(rfid_number))
             # WATCH OUT. Signal "int" values are 32-bit. So we should
             # emit a Python object instead.
             rfid_event = RfidEvent(
@@ -267,7 +269,9 @@ class RfidOwner(SerialOwner):  # GUI thread
         self.reader_id = rfid_config.id  # used by main GUI
         self.name = rfid_config.name  # used by main GUI
         self.reset_requested.connect(self.controller.reset)
-        self.controller.rfid_received.connect(self.rfid_received)  # different thread  # noqa
+        # Different thread:
+        self.controller.rfid_received.connect(self.rfid_received,
+                                              Qt.QueuedConnection)
 
     def reset(self) -> None:
         self.reset_requested.emit()
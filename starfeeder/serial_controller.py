@@ -19,7 +19,10 @@
 
 from collections import deque, OrderedDict
 import logging
+import os
 import platform
+import select
+import threading
 import traceback
 from typing import Any, Dict, Type, TypeVar  # if this fails under Python 3.5.1, upgrade to 3.5.2  # noqa
 # ... under Python 3.4/earlier, "typing" is an external module installed with
@@ -55,11 +58,25 @@ NO_BYTES = b''
 DEBUG_WRITE_TIMING = False
 
 READ_TIMEOUT_SEC = 0.01
+# ... only used for polling reads (Windows); under POSIX we select() on the
+# port and a wake-up pipe instead
+USE_SELECT_FOR_READS = platform.system() != 'Windows'
+# ... select() works on serial port file descriptors under POSIX, but under
+# Windows only on sockets
+READ_CHUNK_SIZE = 4096  # max bytes per os.read() when using select()
 WRITE_TIMEOUT_SEC = 5.0  # None for blocking writes
 # ... but blocking writes can cause the app to freeze if the serial port breaks
 INTER_BYTE_TIMEOUT_SEC = None
 
 
+def debug_enabled() -> bool:
+    """
+    Will debug() messages from our serial classes go anywhere? Use this to
+    avoid building debug messages on busy paths when they'd be thrown away.
+    """
+    return log.isEnabledFor(logging.DEBUG)
+
+
 # class SerialReceiveMessage(object):
 #     def __init__(self, data: bytes, timestamp: arrow.Arrow) -> None:
 #         self.data = data
@@ -87,7 +104,13 @@ class SerialReader(QObject, StatusMixin):  # separate reader thread
 
         self.len_eol = len(eol)
         self.finish_requested = False
-        self.residual = b''
+        self.residual = bytearray()
+        self.wake_read_fd = None  # type: int
+        self.wake_write_fd = None  # type: int
+        # stop() runs in another thread; this lock stops it writing to the
+        # wake-up pipe while the reader is closing it (by which time the file
+        # descriptor number might have been reused for something else).
+        self.wake_lock = threading.Lock()
 
     @pyqtSlot(Serial)
     @exit_on_exception
@@ -96,19 +119,10 @@ class SerialReader(QObject, StatusMixin):  # separate reader thread
         self.debug("SerialReader starting. Using port {}".format(serial_port))
         self.finish_requested = False
         try:
-            while not self.finish_requested:
-                # We could use self.serial_port.readline(), noting also
-                # http://pyserial.readthedocs.org/en/latest/shortintro.html
-                # But we have to do some EOL stripping anyway, so let's just
-                # do it in the raw.
-                # Note the method used at
-                # https://github.com/pyserial/pyserial/blob/master/serial/threaded/__init__.py#L196  # noqa
-
-                # read all that is there or wait for one byte (blocking)
-                data = self.serial.read(self.serial.in_waiting or 1)
-                # ... will return b'' if no data
-                if len(data) > 0:
-                    self.process_data(data)
+            if USE_SELECT_FOR_READS:
+                self.read_with_select()
+            else:
+                self.read_with_polling()
         # except serial.SerialException as e:
         except Exception as e:  # serial port errors
             self.error("Serial port error: {}; stopping".format(str(e)))
@@ -122,19 +136,112 @@ class SerialReader(QObject, StatusMixin):  # separate reader thread
         #   e.g. ?if we use parity E with a socat port. So catch everything.
         self.finish()
 
+    def read_with_polling(self) -> None:
+        """
+        Read loop that wakes every READ_TIMEOUT_SEC to check whether we've
+        been asked to stop. Used where select() won't work on a serial port.
+        """
+        # Bind what we use per iteration to locals, outside the loop.
+        serial_port = self.serial_port
+        read = serial_port.read
+        process_data = self.process_data
+        while not self.finish_requested:
+            # We could use self.serial_port.readline(), noting also
+            # http://pyserial.readthedocs.org/en/latest/shortintro.html
+            # But we have to do some EOL stripping anyway, so let's just
+            # do it in the raw.
+            # Note the method used at
+            # https://github.com/pyserial/pyserial/blob/master/serial/threaded/__init__.py#L196  # noqa
+
+            # read all that is there or wait for one byte (blocking)
+            data = read(serial_port.in_waiting or 1)
+            # ... will return b'' if no data
+            if data:
+                process_data(data)
+
+    def read_with_select(self) -> None:
+        """
+        Read loop that sleeps in select() until either the serial port has
+        data or stop() writes to our wake-up pipe. No timeout polling, so an
+        idle port costs nothing and stop() takes effect immediately.
+        """
+        with self.wake_lock:
+            self.wake_read_fd, self.wake_write_fd = os.pipe()
+            os.set_blocking(self.wake_read_fd, False)
+        try:
+            self.drain_wake_pipe()
+            port_fd = self.serial_port.fileno()
+            # Bind what we use per iteration to locals, outside the loop.
+            fds = [port_fd, self.wake_read_fd]
+            no_fds = []
+            select_ = select.select
+            read = os.read
+            process_data = self.process_data
+            while not self.finish_requested:
+                readable, _, _ = select_(fds, no_fds, no_fds)
+                if port_fd in readable:
+                    # select() has told us there's data, so read the file
+                    # descriptor directly, bypassing Serial.read()'s own
+                    # timeout/select machinery.
+                    try:
+                        data = read(port_fd, READ_CHUNK_SIZE)
+                    except (BlockingIOError, InterruptedError):
+                        # pySerial opens the port non-blocking; like its own
+                        # read(), treat EAGAIN/EINTR as "nothing after all".
+                        continue
+                    if not data:
+                        # As per pySerial: readable but no data means the
+                        # device has gone (e.g. USB adapter unplugged).
+                        raise serial.SerialException(
+                            "Device reports readiness to read but returned "
+                            "no data (device disconnected?)")
+                    process_data(data)
+        finally:
+            with self.wake_lock:
+                os.close(self.wake_read_fd)
+                os.close(self.wake_write_fd)
+                self.wake_read_fd = None
+                self.wake_write_fd = None
+
+    def drain_wake_pipe(self) -> None:
+        """
+        Discards any stale wake-up bytes, so they can't cut short a select().
+        """
+        try:
+            while os.read(self.wake_read_fd, READ_CHUNK_SIZE):
+                pass
+        except BlockingIOError:  # empty
+            pass
+
     def process_data(self, data: bytes) -> None:
         """
         Adds the incoming data to any stored residual, splits it into lines,
         and sends each line on to the receiver.
+
+        The residual is a bytearray that we extend in place and scan with
+        find(), starting just before the new data (an EOL may straddle the
+        old and new data), so bytes already scanned aren't copied or
+        searched again.
         """
         # self.debug("data: {}".format(repr(data)))  # very verbose!
+        residual = self.residual
+        eol = self.eol
+        len_eol = self.len_eol
+        scan_from = max(0, len(residual) - len_eol + 1)
+        residual += data
+        idx = residual.find(eol, scan_from)
+        if idx == -1:
+            # No complete line yet; just accumulate.
+            return
         timestamp = arrow.now()
-        data = self.residual + data
-        fragments = data.split(self.eol)
-        lines = fragments[:-1]
-        self.residual = fragments[-1]
-        for line in lines:
-            self.debug("line: {}".format(repr(line)))
+        show_lines = debug_enabled()
+        pos = 0
+        while idx != -1:
+            line = residual[pos:idx]
+            pos = idx + len_eol
+            idx = residual.find(eol, pos)
+            if show_lines:
+                self.debug("line: {}".format(repr(bytes(line))))
             # self.line_received.emit(line, timestamp)
             # self.line_received.emit(b'Z5A2080A70C2C0001', timestamp)
             # msg = SerialReceiveMessage(data=line, timestamp=timestamp)
@@ -143,9 +250,11 @@ class SerialReader(QObject, StatusMixin):  # separate reader thread
                 decoded = line.decode(self.input_encoding)
             except UnicodeDecodeError:
                 self.critical("Received input that {} won't decode, ignoring: "
-                              "{}".format(self.input_encoding, repr(data)))
+                              "{}".format(self.input_encoding,
+                                          repr(bytes(line))))
                 continue
             self.line_received.emit(decoded, timestamp)
+        del residual[:pos]
 
     @pyqtSlot()
     @exit_on_exception
@@ -188,8 +297,14 @@ class SerialReader(QObject, StatusMixin):  # separate reader thread
         # default Auto Connection), executes the slot in the receiver's thread.
         # In other words, we don't have to use a mutex on this variable because
         # we are accessing it via the Qt signal/slot mechanism.
+        # When reading via select(), we also have to wake the reader up.
         self.debug("stopping")
         self.finish_requested = True
+        with self.wake_lock:
+            # Under the lock, the descriptor is either ours and open, or None
+            # (reader not selecting, or finished).
+            if self.wake_write_fd is not None:
+                os.write(self.wake_write_fd, b'x')
 
     def finish(self) -> None:
         self.finished.emit()
@@ -275,7 +390,8 @@ class SerialWriter(QObject, StatusMixin):  # separate writer thread
         """
         try:
             outdata = data + self.eol
-            self.debug("sending: {}".format(repr(outdata)))
+            if debug_enabled():
+                self.debug("sending: {}".format(repr(outdata)))
             if DEBUG_WRITE_TIMING:
                 t1 = arrow.utcnow()
             self.serial_port.write(outdata)
@@ -307,6 +423,8 @@ class SerialController(QObject, StatusMixin):  # separate controller thread
         super().__init__(parent=parent, name=name, logger=log, **kwargs)
         self.output_encoding = output_encoding
 
+    debug_enabled = staticmethod(debug_enabled)
+
     @pyqtSlot(str, arrow.Arrow)
     def on_receive(self, data: str, timestamp: arrow.Arrow) -> None:
         """Should be overridden."""
@@ -470,17 +588,31 @@ class SerialOwner(QObject, StatusMixin):  # GUI thread
         self.writerthread.finished.connect(self.writerthread_finished)
 
         # Connect the status events
-        self.reader.status_sent.connect(self.status_sent)
-        self.reader.error_sent.connect(self.error_sent)
-        self.writer.status_sent.connect(self.status_sent)
-        self.writer.error_sent.connect(self.error_sent)
-        self.controller.status_sent.connect(self.status_sent)
-        self.controller.error_sent.connect(self.error_sent)
+        # ... all from worker threads to us (GUI thread), so queued. We say
+        # so explicitly for these and the other per-message connections
+        # below; the one-off start/stop connections are left as automatic.
+        self.reader.status_sent.connect(self.status_sent, Qt.QueuedConnection)
+        self.reader.error_sent.connect(self.error_sent, Qt.QueuedConnection)
+        self.writer.status_sent.connect(self.status_sent, Qt.QueuedConnection)
+        self.writer.error_sent.connect(self.error_sent, Qt.QueuedConnection)
+        self.controller.status_sent.connect(self.status_sent,
+                                            Qt.QueuedConnection)
+        self.controller.error_sent.connect(self.error_sent,
+                                           Qt.QueuedConnection)
         self.status_requested.connect(self.controller.report_status)
 
         # Connect the control events
-        self.reader.line_received.connect(self.controller.on_receive)
-        self.controller.data_send_requested.connect(self.writer.send)
+        self.reader.line_received.connect(self.controller.on_receive,
+                                          Qt.QueuedConnection)
+        # ... deliberately queued, not direct. A DirectConnection would run
+        # the controller's on_receive() in the reader thread, concurrently
+        # with the controller's other slots (tare, ping, etc.) running in the
+        # controller thread and sharing its state (e.g. the command queue).
+        # The controller also owns QTimers, which need the event loop of the
+        # controller thread; the reader thread has none (it sits in its read
+        # loop). So the controller keeps its own thread.
+        self.controller.data_send_requested.connect(self.writer.send,
+                                                    Qt.QueuedConnection)
 
     # -------------------------------------------------------------------------
     # General state control
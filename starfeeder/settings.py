@@ -18,26 +18,58 @@
 """
 
 import os
+import sqlite3
 from typing import Any, Dict
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from starfeeder.constants import DB_URL_ENV_VAR
 
 dbsettings = {
     # three slashes for a relative path
-    'url': '?',
+    'url': None,  # set from the command line or, failing that, DB_URL_ENV_VAR
     # 'echo': True,
     'echo': False,
     'connect_args': {
         # 'timeout': 15,
     },
+    # SQLite only: use write-ahead logging? Not safe if the database is on a
+    # network drive (all users must share memory on one host).
+    'sqlite_wal': True,
 }
 
+SQLITE_PRAGMAS = [
+    # Temporary tables/indexes (e.g. for sorting) in RAM, not on disk.
+    "PRAGMA temp_store=MEMORY",
+]
+SQLITE_WAL_PRAGMAS = [
+    # Write-ahead logging: readers (the GUI) don't block the writer (the
+    # Whisker task thread), and commits don't rewrite the main database file.
+    "PRAGMA journal_mode=WAL",
+    # Safe with WAL (survives application crashes; at worst loses the last
+    # transaction on power failure), and avoids an fsync per commit.
+    "PRAGMA synchronous=NORMAL",
+    # Read through a memory map of up to 256 MiB rather than read() calls.
+    # Like WAL, for local disks only.
+    "PRAGMA mmap_size=268435456",
+]
+SQLITE_NO_WAL_PRAGMAS = [
+    # The journal mode persists in the database file, so switch back
+    # explicitly if WAL was used before.
+    "PRAGMA journal_mode=DELETE",
+]
+
 
 def get_database_settings() -> Dict[str, Any]:
-    if DB_URL_ENV_VAR not in os.environ:
-        raise ValueError(
-            "Environment variable {} not specified".format(DB_URL_ENV_VAR))
-    set_database_url(os.environ[DB_URL_ENV_VAR])
+    # The URL is resolved once: an explicit set_database_url() (e.g. from
+    # --dburl) wins; otherwise we fall back to the environment variable.
+    if dbsettings['url'] is None:
+        if DB_URL_ENV_VAR not in os.environ:
+            raise ValueError(
+                "Environment variable {} not specified".format(
+                    DB_URL_ENV_VAR))
+        set_database_url(os.environ[DB_URL_ENV_VAR])
     return dbsettings
     # http://docs.sqlalchemy.org/en/latest/core/engines.html
     # http://stackoverflow.com/questions/15065037
@@ -57,3 +89,33 @@ def set_database_url(url: str) -> None:
 def set_database_echo(echo: bool) -> None:
     global dbsettings
     dbsettings['echo'] = echo
+
+
+def set_database_wal(use_wal: bool) -> None:
+    global dbsettings
+    dbsettings['sqlite_wal'] = use_wal
+
+
+# noinspection PyUnusedLocal
+def _set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    if dbsettings['sqlite_wal']:
+        pragmas = SQLITE_PRAGMAS + SQLITE_WAL_PRAGMAS
+    else:
+        pragmas = SQLITE_PRAGMAS + SQLITE_NO_WAL_PRAGMAS
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def enable_sqlite_pragmas() -> None:
+    """
+    Sets SQLITE_PRAGMAS, plus SQLITE_WAL_PRAGMAS or SQLITE_NO_WAL_PRAGMAS
+    (see set_database_wal()), on every new SQLite connection, from any engine
+    (including those created for us by whisker.sqlalchemy and by Alembic).
+    Other databases are unaffected.
+    """
+    if not event.contains(Engine, "connect", _set_sqlite_pragmas):
+        event.listen(Engine, "connect", _set_sqlite_pragmas)
@@ -17,6 +17,7 @@
     limitations under the License.
 """
 
+from contextlib import ExitStack
 import logging
 
 import arrow
@@ -25,7 +26,8 @@ from whisker.sqlalchemy import session_thread_scope
 from whisker.qt import exit_on_exception
 from whisker.qtclient import WhiskerTask
 
-from PyQt5.QtCore import QObject, pyqtSlot
+from PyQt5.QtCore import QObject, QTimer, pyqtSlot
+from sqlalchemy.orm.session import Session
 from starfeeder.models import (
     MassEvent,  # for type hints
     MassEventRecord,
@@ -38,22 +40,68 @@ from starfeeder.version import VERSION
 
 log = logging.getLogger(__name__)
 
+DB_FLUSH_INTERVAL_MS = 200  # max time an event waits before being written
+DB_FLUSH_MAX_EVENTS = 50  # ... or write as soon as this many are waiting
+
+RFID_EVENT_TEMPLATE = "RFID_EVENT: reader {}, RFID {}, timestamp {}"
+MASS_EVENT_TEMPLATE = (
+    "MASS_EVENT: reader {}, RFID {}, balance {}, mass {} kg, timestamp {}"
+)
+
 
 class WeightWhiskerTask(WhiskerTask):  # Whisker thread B
     """Doesn't define an end, deliberately."""
 
-    def __init__(self, wcm_prefix: str = "", parent: QObject = None,
+    def __init__(self, wcm_prefix: str = "",
+                 rfid_effective_time_s: float = None,
+                 parent: QObject = None,
                  name: str = "whisker_task", **kwargs) -> None:
         super().__init__(parent=parent, name=name, **kwargs)
         self.wcm_prefix = wcm_prefix
+        # Per-event message formats, with our prefix built in (escaped, in
+        # case it contains braces).
+        escaped_prefix = (wcm_prefix or '').replace('{', '{{').replace(
+            '}', '}}')
+        self.rfid_event_format = (escaped_prefix + RFID_EVENT_TEMPLATE).format
+        self.mass_event_format = (escaped_prefix + MASS_EVENT_TEMPLATE).format
         self.dbsettings = get_database_settings()
-        self.rfid_effective_time_s = None
+        self.rfid_effective_time_s = rfid_effective_time_s
+        self.pending_rfid_events = []
+        self.pending_mass_events = []
+        self.flush_timer = QTimer(self)  # parented; see SerialWriter
+        self.flush_timer.setSingleShot(True)
+        # noinspection PyUnresolvedReferences
+        self.flush_timer.timeout.connect(self.flush_events)
+        # We are the only database writer, so we keep one session for our
+        # lifetime (opened in our own thread) rather than one per write.
+        self.session_exit_stack = ExitStack()
+        self.session = None
+
+    def open_session(self) -> Session:
+        if self.session is None:
+            self.session = self.session_exit_stack.enter_context(
+                session_thread_scope(self.dbsettings))
+        return self.session
+
+    def close_session(self) -> None:
+        self.session = None
+        self.session_exit_stack.close()
 
     @pyqtSlot()
     def thread_started(self) -> None:
-        with session_thread_scope(self.dbsettings) as session:
+        session = self.open_session()
+        if self.rfid_effective_time_s is None:
+            # Not passed in by our creator; look it up.
             config = MasterConfig.get_singleton(session)
             self.rfid_effective_time_s = config.rfid_effective_time_s
+            session.commit()
+
+    @pyqtSlot()
+    @exit_on_exception
+    def stop(self) -> None:
+        self.flush_events()
+        self.close_session()
+        super().stop()
 
     @pyqtSlot()
     @exit_on_exception
@@ -70,11 +118,6 @@ class WeightWhiskerTask(WhiskerTask):  # Whisker thread B
         # if event == "bop":
         #     self.status("boop")
 
-    def broadcast(self, msg: str) -> None:
-        if self.wcm_prefix:
-            msg = "{}{}".format(self.wcm_prefix, msg)
-        self.whisker.broadcast(msg)
-
     @pyqtSlot(RfidEvent)
     @exit_on_exception
     def on_rfid(self, rfid_event: RfidEvent) -> None:
@@ -86,24 +129,20 @@ class WeightWhiskerTask(WhiskerTask):  # Whisker thread B
 
         Only one thread should be writing to the database, to avoid locks.
 
-        Don't hold the session too long, on general principles.
+        Database writes are batched; see flush_events().
         """
         if not isinstance(rfid_event, RfidEvent):
             log.critical("Bad rfid_event: {}".format(rfid_event))
             return
-        with session_thread_scope(self.dbsettings) as session:
-            RfidEventRecord.record_rfid_detection(
-                session, rfid_event, self.rfid_effective_time_s)
+        self.pending_rfid_events.append(rfid_event)
+        self.schedule_flush()
         # self.status("RFID received: {}".format(rfid_event))
         if self.whisker.is_connected():
-            self.broadcast(
-                "RFID_EVENT: reader {reader}, RFID {rfid}, "
-                "timestamp {timestamp}".format(
-                    rfid=rfid_event.rfid,
-                    reader=rfid_event.reader_name,
-                    timestamp=rfid_event.timestamp,
-                )
-            )
+            self.whisker.broadcast(self.rfid_event_format(
+                rfid_event.reader_name,
+                rfid_event.rfid,
+                rfid_event.timestamp,
+            ))
 
     @pyqtSlot(MassEvent)
     @exit_on_exception
@@ -118,16 +157,52 @@ class WeightWhiskerTask(WhiskerTask):  # Whisker thread B
             return
         if not mass_event.locked or mass_event.rfid is None:
             return
-        with session_thread_scope(self.dbsettings) as session:
-            MassEventRecord.record_mass_detection(session, mass_event)
+        self.pending_mass_events.append(mass_event)
+        self.schedule_flush()
         if self.whisker.is_connected():
-            self.broadcast(
-                "MASS_EVENT: reader {reader}, RFID {rfid}, balance {balance}, "
-                "mass {mass_kg} kg, timestamp {timestamp}".format(
-                    reader=mass_event.reader_name,
-                    rfid=mass_event.rfid,
-                    balance=mass_event.balance_name,
-                    mass_kg=mass_event.mass_kg,
-                    timestamp=mass_event.timestamp,
-                )
-            )
+            self.whisker.broadcast(self.mass_event_format(
+                mass_event.reader_name,
+                mass_event.rfid,
+                mass_event.balance_name,
+                mass_event.mass_kg,
+                mass_event.timestamp,
+            ))
+
+    def schedule_flush(self) -> None:
+        """
+        Called when an event has been queued for the database. Writes the
+        queue when it gets long, or shortly after its first event otherwise.
+        """
+        n_pending = (len(self.pending_rfid_events) +
+                     len(self.pending_mass_events))
+        if n_pending >= DB_FLUSH_MAX_EVENTS:
+            self.flush_events()
+        elif not self.flush_timer.isActive():
+            self.flush_timer.start(DB_FLUSH_INTERVAL_MS)
+
+    @pyqtSlot()
+    @exit_on_exception
+    def flush_events(self) -> None:
+        """
+        Writes all queued RFID and mass events in a single transaction,
+        rather than one session/commit per event.
+        """
+        self.flush_timer.stop()
+        if not self.pending_rfid_events and not self.pending_mass_events:
+            return
+        rfid_events = self.pending_rfid_events
+        mass_events = self.pending_mass_events
+        self.pending_rfid_events = []
+        self.pending_mass_events = []
+        session = self.open_session()
+        try:
+            for rfid_event in rfid_events:
+                # Sequential, since each may update the previous one's record.
+                RfidEventRecord.record_rfid_detection(
+                    session, rfid_event, self.rfid_effective_time_s,
+                    commit=False)
+            MassEventRecord.record_mass_detections(session, mass_events)
+            session.commit()  # ASAP to unlock database
+        except Exception:
+            session.rollback()  # leave the session usable for next time
+            raise
@@ -41,19 +41,47 @@ def title(msg):
     print(SEP)
 
 
-def require_debian_package(package):
+def read_requirements(filename):
+    """
+    Returns the requirements in a file, one per line, as a tuple, ignoring
+    blank lines and comments.
+    """
+    with open(filename) as f:
+        lines = (line.split('#', 1)[0].strip() for line in f)
+        return tuple(line for line in lines if line)
+
+
+def get_installed_debian_packages():
+    """
+    Returns the set of installed Debian packages, from a single dpkg-query
+    call.
+    """
+    installed = set()
+    # Stream the output line by line, rather than reading it all first.
+    with subprocess.Popen(['dpkg-query', '-W', '-f=${Package} ${Status}\n'],
+                          stdout=subprocess.PIPE) as proc:
+        for line in proc.stdout:
+            # e.g. "libc6 install ok installed"; deinstalled packages whose
+            # config files remain show "... config-files", so check the state.
+            parts = line.split()
+            if len(parts) == 4 and parts[3] == b'installed':
+                installed.add(parts[0].decode())
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return installed
+
+
+def require_debian_packages(packages):
     if not LINUX:
         return
-    proc = subprocess.Popen(
-        ['dpkg', '-l', package],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.communicate()
-    retcode = proc.returncode
-    if retcode == 0:
+    installed = get_installed_debian_packages()
+    missing = [p for p in packages if p not in installed]
+    if not missing:
         return
-    print("You must install the package {package}. On Ubuntu, use the command:"
-          "\n"
-          "    sudo apt-get install {package}".format(package=package))
+    print("You must install the package(s) {packages}. On Ubuntu, use the "
+          "command:\n"
+          "    sudo apt-get install {packages}".format(
+              packages=" ".join(missing)))
     sys.exit(1)
 
 
@@ -82,11 +110,7 @@ if __name__ == '__main__':
         title("Prerequisites, from " + DEBIAN_REQ_FILE)
         print("XDG_CACHE_HOME: {}".format(os.environ.get('XDG_CACHE_HOME',
                                                          None)))
-        with open(DEBIAN_REQ_FILE) as f:
-            for line in f:
-                package = line.strip()
-                if package:
-                    require_debian_package(package)
+        require_debian_packages(read_requirements(DEBIAN_REQ_FILE))
         print('OK')
 
         title("Ensuring virtualenv is installed for system"
@@ -43,11 +43,15 @@ NOTES 2016-12-01
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
 import platform
 import shutil
 import subprocess
 import sys
+import tarfile
+import zipfile
 # import PyInstaller.building.utils
 
 if sys.version_info[0] < 3:
@@ -87,6 +91,26 @@ ZIPFILEBASE = os.path.join(DIST_DIR, 'starfeeder_{VERSION}_{PLATFORM}'.format(
     ZIPEXT=ZIPEXT,
 ))
 
+# Built archives, keyed on a hash of everything that goes into them:
+BUILD_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.path.expanduser('~'), '.cache')),
+    'starfeeder-build')
+HASHED_DIRS = [
+    os.path.join(PROJECT_BASE_DIR, 'doc'),
+    os.path.join(PROJECT_BASE_DIR, 'starfeeder'),
+]
+HASHED_FILES = [
+    DOCMAKER,
+    os.path.join(PROJECT_BASE_DIR, 'requirements.txt'),
+    os.path.join(PROJECT_BASE_DIR, 'setup.py'),
+    SPECFILE,
+]
+
+# Much of the bundle is already-compressed binaries, so fast compression
+# loses little size but saves a lot of time.
+ARCHIVE_COMPRESSLEVEL = 1
+
 SEP = "=" * 79
 
 
@@ -96,14 +120,122 @@ def title(msg):
     print(SEP)
 
 
+def get_source_files():
+    filenames = list(HASHED_FILES)
+    for topdir in HASHED_DIRS:
+        for dirpath, dirnames, files in os.walk(topdir):
+            dirnames[:] = [d for d in dirnames if d != '__pycache__']
+            filenames.extend(os.path.join(dirpath, f) for f in files
+                             if not f.endswith('.pyc'))
+    return sorted(filenames)
+
+
+def hash_file(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def get_build_environment():
+    """
+    Describes the tools and installed packages that go into the build, so
+    that upgrading any of them (e.g. "pip install -U") invalidates the cache.
+    Editable installs (i.e. this package) are left out; their sources are
+    hashed directly, and the line would change with every commit.
+    """
+    frozen = subprocess.check_output([PYTHON, '-m', 'pip', 'freeze'],
+                                     universal_newlines=True)
+    packages = [line for line in frozen.splitlines()
+                if line and not line.startswith('-e ')]
+    pyinstaller_version = subprocess.check_output(
+        ['pyinstaller', '--version'], universal_newlines=True).strip()
+    return "\n".join([
+        "platform: {}".format(PLATFORM),
+        "python: {}".format(sys.version),
+        "pyinstaller: {}".format(pyinstaller_version),
+    ] + sorted(packages)) + "\n"
+
+
+def get_source_hash():
+    """
+    SHA-256 over the build environment (platform, Python, PyInstaller and
+    installed package versions), and the names and contents of all files
+    that go into the build. Files are read and hashed in parallel
+    (I/O-bound; hashlib releases the GIL for large inputs).
+    """
+    filenames = get_source_files()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        digests = list(executor.map(hash_file, filenames))
+    h = hashlib.sha256()
+    h.update(get_build_environment().encode('utf8'))
+    for filename, digest in zip(filenames, digests):
+        h.update(os.path.relpath(filename, PROJECT_BASE_DIR).encode('utf8'))
+        h.update(digest)
+    return h.hexdigest()
+
+
+def prune_build_cache(keep):
+    """
+    Deletes cached archives other than "keep" (the one for the current
+    sources and environment), so the cache doesn't grow without bound.
+    """
+    for name in os.listdir(BUILD_CACHE_DIR):
+        filename = os.path.join(BUILD_CACHE_DIR, name)
+        if filename != keep and os.path.isfile(filename):
+            os.remove(filename)
+
+
+def make_archive(base_name, root_dir):
+    """
+    Like shutil.make_archive(base_name, ZIPFORMAT, root_dir), but using
+    ARCHIVE_COMPRESSLEVEL. Returns the archive's filename.
+    """
+    if ZIPFORMAT == 'zip':
+        filename = base_name + '.zip'
+        kwargs = {}
+        if sys.version_info >= (3, 7):  # compresslevel is new in 3.7
+            kwargs['compresslevel'] = ARCHIVE_COMPRESSLEVEL
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED,
+                             **kwargs) as zf:
+            for dirpath, dirnames, filenames in os.walk(root_dir):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    fullpath = os.path.join(dirpath, name)
+                    zf.write(fullpath, os.path.relpath(fullpath, root_dir))
+    else:
+        filename = base_name + '.tar.gz'
+        with tarfile.open(filename, 'w:gz',
+                          compresslevel=ARCHIVE_COMPRESSLEVEL) as tf:
+            tf.add(root_dir, arcname=os.curdir)
+    return filename
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true', help="Verbose")
+    parser.add_argument('--force', action='store_true',
+                        help="Rebuild even if an archive built from identical "
+                             "sources is cached")
     args = parser.parse_args()
 
+    source_hash = get_source_hash()
+    cached_archive = os.path.join(
+        BUILD_CACHE_DIR, "{}.{}".format(source_hash, ZIPEXT))
+    if os.path.isfile(cached_archive) and not args.force:
+        title("Sources unchanged; reusing cached build")
+        os.makedirs(DIST_DIR, exist_ok=True)
+        archive = ZIPFILEBASE + "." + ZIPEXT
+        shutil.copyfile(cached_archive, archive)
+        print("To distribute, use {} (copied from {}; use --force to "
+              "rebuild)".format(archive, cached_archive))
+        sys.exit(0)
+
     title("Deleting old distribution...")
-    shutil.rmtree(BUILD_DIR, ignore_errors=True)
-    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    # The two trees are independent and removal is I/O-bound, so delete them
+    # in parallel (skipping any that aren't there, e.g. on a fresh checkout).
+    old_dirs = [d for d in (BUILD_DIR, DIST_DIR) if os.path.isdir(d)]
+    if old_dirs:
+        with ThreadPoolExecutor(max_workers=len(old_dirs)) as executor:
+            list(executor.map(shutil.rmtree, old_dirs))
     os.makedirs(BUILD_DIR, exist_ok=True)
     os.makedirs(DIST_DIR, exist_ok=True)
 
@@ -119,16 +251,19 @@ if __name__ == '__main__':
     )
 
     title("Zipping to {}...".format(ZIPFILEBASE))
-    zipfile = shutil.make_archive(ZIPFILEBASE, ZIPFORMAT, DIST_SUBDIR)
+    archive = make_archive(ZIPFILEBASE, DIST_SUBDIR)
+    os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+    shutil.copyfile(archive, cached_archive)
+    prune_build_cache(keep=cached_archive)
 
     print("""
 The {DIST_SUBDIR} directory should contain everything you need to run.
 Run with: {LAUNCHFILE}
 Look for warnings in: {WARNFILE}
-To distribute, use {zipfile}
+To distribute, use {archive}
     """.format(
         DIST_SUBDIR=DIST_SUBDIR,
         LAUNCHFILE=LAUNCHFILE,
         WARNFILE=WARNFILE,
-        zipfile=zipfile,
+        archive=archive,
     ))